@@ -0,0 +1,66 @@
+"""Peak memory of reading a chatty process line by line vs all at once.
+
+A child process prints lines shaped like rsync's --itemize-changes
+output.  The streamed peak should stay flat as the line count grows
+while the buffered one grows with it.
+
+    python benchmarks/stream_memory.py
+"""
+
+import subprocess
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from toolbox.stream import stream
+
+LINE_COUNTS = [10_000, 100_000, 1_000_000]
+
+CHILD = """
+import sys
+for i in range(int(sys.argv[1])):
+    print(f">f+++++++++ web/assets/images/gallery/photo-{i:08}.jpg")
+"""
+
+
+def _child(lines: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-c", CHILD, str(lines)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def streamed(lines: int) -> int:
+    count = 0
+
+    def on_stdout(line):
+        nonlocal count
+        count += 1
+
+    tracemalloc.start()
+    stream(_child(lines), on_stdout, lambda line: None)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert count == lines
+    return peak
+
+
+def buffered(lines: int) -> int:
+    tracemalloc.start()
+    stdout, stderr = _child(lines).communicate()
+    count = len(stdout.decode().splitlines())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert count == lines
+    return peak
+
+
+if __name__ == "__main__":
+    print(f"{'lines':>10}  {'streamed':>10}  {'buffered':>10}")
+    for lines in LINE_COUNTS:
+        s = streamed(lines) / 1024
+        b = buffered(lines) / 1024
+        print(f"{lines:>10}  {s:>9.0f}K  {b:>9.0f}K")
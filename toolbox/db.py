@@ -0,0 +1,517 @@
+import gzip
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from toolbox.config import project
+from toolbox.output import l
+from toolbox.remote import ssh_command
+
+INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+
+# Every table in the db, its type, its size and its primary key column if
+# it has a single integer one (which is the only kind that can be chunked).
+TABLES_QUERY = f"""
+SELECT t.table_name, t.table_type, COALESCE(t.data_length, 0), COALESCE(p.column_name, '')
+FROM information_schema.tables t
+LEFT JOIN (
+    SELECT table_name, MIN(column_name) AS column_name
+    FROM information_schema.columns
+    WHERE table_schema = DATABASE() AND column_key = 'PRI'
+    GROUP BY table_name
+    HAVING COUNT(*) = 1
+        AND MAX(data_type IN ({", ".join(f"'{i}'" for i in INTEGER_TYPES)})) = 1
+) p ON p.table_name = t.table_name
+WHERE t.table_schema = DATABASE()
+ORDER BY t.table_name
+"""
+
+# Transactions opened since the read lock was taken by other sessions of
+# the same user, which are the dumps.
+STARTED_QUERY = """
+SELECT 'started', COUNT(*)
+FROM information_schema.innodb_trx t
+JOIN information_schema.processlist p ON p.id = t.trx_mysql_thread_id
+WHERE p.user = SUBSTRING_INDEX(USER(), '@', 1)
+    AND p.id <> CONNECTION_ID()
+    AND t.trx_started >= @locked_at;
+"""
+
+# Run in front of every remote mysql command.  The password is read from
+# the first line of stdin so it never shows up in a command line, and
+# pipefail makes a failing mysqldump fail the whole pipeline.
+PREAMBLE = (
+    'IFS= read -r MYSQL_PWD; if [ -n "$MYSQL_PWD" ]; then export MYSQL_PWD; fi; '
+    "set -o pipefail; "
+)
+
+# Seconds to wait for the read lock, and then for every dump to start.
+LOCK_TIMEOUT = 30
+
+
+class DB:
+
+    def __init__(
+        self, real: bool, server_name: str, quiet: int = 0, jobs: int = 1
+    ) -> None:
+        """Initialize the DB class.
+
+        :param real: true to actually run the commands, else just print them.
+        :param server_name: the name of the server to pull from or put to.
+        :param quiet: 1 to output only the filename, 2 to output nothing.
+        :param jobs: number of connections to dump over at once when pulling.
+        """
+        self.server = project.get_server_by_name(server_name)
+        self.real = real
+        self.quiet = quiet
+        self.jobs = max(1, jobs)
+
+        if not self.server.ssh:
+            l.error(f"Server has no ssh settings ({self.server.name}).", exit=True)
+        if not self.server.mysql:
+            l.error(f"Server has no mysql settings ({self.server.name}).", exit=True)
+        self.mysql = self.server.mysql[0]
+
+        # the running remote commands, so they can be stopped if one fails
+        self._processes = set()
+        self._processes_lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def pull(self, tag: str = None) -> Path:
+        """Dump the remote db into a gzipped sql file in the pulls_dir.
+
+        With more than one job, the tables are split into that many
+        groups of about the same size, with tables that are bigger than
+        their share split by primary key range.  Each group is dumped
+        over its own connection and gzipped on its own, and the results
+        are joined into one file.  A file made of several gzip members
+        is still a valid gzip file, so `db put` and `gunzip` read it like
+        any other.
+
+        To give every group the same snapshot, a read lock is held on
+        the db until each dump has opened its transaction, which blocks
+        writes for a moment.  That needs the RELOAD and PROCESS
+        privileges, without them the groups are dumped at slightly
+        different points in time and a warning is shown.
+
+        :param tag: added to the generated filename.
+        :return: the path of the gzipped sql file.
+        """
+        if not project.pulls_dir:
+            l.error("Project has no pulls_dir.", exit=True)
+
+        timestamp = datetime.now().strftime("%y-%m-%d_%H-%M-%S")
+        parts = [project.name, self.server.name, timestamp]
+        if tag:
+            parts.append(tag)
+        filename = Path(project.pulls_dir, f"{'-'.join(parts)}.sql.gz")
+
+        if self.jobs == 1:
+            self._dump_stream([], filename)
+        else:
+            self._parallel_pull(filename)
+
+        if self.real:
+            if self.quiet == 1:
+                print(filename)
+            elif not self.quiet:
+                l.info(f"Saved {filename}")
+        return filename
+
+    def put(self, sql_gz: os.PathLike) -> None:
+        """Overwrite the remote db with a gzipped sql file.
+
+        :param sql_gz: the gzipped sql file to upload.
+        """
+        mysql = ["mysql"] + self._mysql_args() + [self.mysql.db]
+        self._remote(shlex.join(mysql), sql_gz=sql_gz)
+
+    def _parallel_pull(self, filename: Path) -> None:
+        """Dump the groups of tables at once and join the results."""
+        if not self.real:
+            self._query(TABLES_QUERY)
+            if not self.quiet:
+                l.info(
+                    f"Tables would be dumped over up to {self.jobs} connections "
+                    f"into {filename}."
+                )
+            return
+
+        groups, views = self._plan_streams()
+        filename.parent.mkdir(parents=True, exist_ok=True)
+
+        # keep the stream files next to the result so the join stays on one disk
+        with tempfile.TemporaryDirectory(dir=filename.parent) as tmp:
+            paths = [Path(tmp, f"{i:05}.sql.gz") for i in range(len(groups))]
+            self._run_streams(groups, paths)
+            if views:
+                # a view can only be created once the tables it uses exist
+                paths.append(Path(tmp, "views.sql.gz"))
+                self._dump_stream(["--no-data"] + views, paths[-1])
+
+            with open(filename, "wb") as out:
+                for path in paths:
+                    with open(path, "rb") as f:
+                        shutil.copyfileobj(f, out)
+
+    def _run_streams(self, streams: List[List[str]], paths: List[Path]) -> None:
+        """Run every dump at the same time, inside one snapshot if possible.
+
+        If a dump fails, the others are stopped and the pull exits.
+        """
+        if not streams:
+            return
+        lock = _ReadLock(self)
+        locked = lock.acquire()
+        if not locked and self.quiet < 2:
+            l.warning(
+                f"Could not lock the db ({lock.error() or 'no reason given'}), "
+                "the tables will not be dumped at the same point in time."
+            )
+
+        pool = ThreadPoolExecutor(max_workers=len(streams))
+        try:
+            futures = [
+                pool.submit(self._dump_stream, stream, path)
+                for stream, path in zip(streams, paths)
+            ]
+            if locked:
+                if not lock.wait_for(len(streams), futures) and self.quiet < 2:
+                    l.warning(
+                        "Not every dump started while the db was locked, "
+                        "the tables will not be dumped at the same point in time."
+                    )
+                lock.release()
+
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [i.exception() for i in done if i.exception()]
+            if failed:
+                self._cancel()
+                pool.shutdown(cancel_futures=True)
+                # a dump that fails has already shown its error and exited
+                if not isinstance(failed[0], SystemExit):
+                    l.error(str(failed[0]))
+                sys.exit(1)
+        finally:
+            lock.release()
+            pool.shutdown(cancel_futures=True)
+
+    def _cancel(self) -> None:
+        """Stop every running remote command."""
+        self._cancelled.set()
+        with self._processes_lock:
+            for process in self._processes:
+                process.terminate()
+
+    def _plan_streams(self) -> Tuple[List[List[str]], List[str]]:
+        """Work out the mysqldump arguments for each connection.
+
+        Tables bigger than their share of the db are split by primary key
+        range, one connection per chunk, and the other tables are spread
+        over the rest of the connections by size.  There are never more
+        connections than jobs.  The views are returned on their own.
+
+        Streams are returned in the order they must be restored in, with
+        each chunk of a table in key order.
+        """
+        tables = []
+        views = []
+        for line in self._query(TABLES_QUERY):
+            name, table_type, size, key = line.split("\t")
+            if table_type == "VIEW":
+                views.append(name)
+            else:
+                tables.append((name, int(size), key))
+
+        share = max(1, sum(size for _, size, _ in tables) / self.jobs)
+        large = [(name, key) for name, size, key in tables if key and size > share]
+        ranges = self._key_ranges(large)
+        sizes = {name: size for name, size, _ in tables}
+        chunks = {name: max(1, round(sizes[name] / share)) for name in ranges}
+
+        def split():
+            return {name: n for name, n in chunks.items() if n > 1}
+
+        def budget():
+            # leave a connection for the tables that are not split
+            return self.jobs - (1 if len(tables) > len(split()) else 0)
+
+        while sum(split().values()) > budget():
+            chunks[max(chunks, key=chunks.get)] -= 1
+
+        streams = []
+        keys = {name: key for name, _, key in tables}
+        for name, n in sorted(split().items()):
+            streams += self._chunk_streams(name, keys[name], *ranges[name], n)
+
+        rest = sorted(
+            [(size, name) for name, size, _ in tables if name not in split()],
+            reverse=True,
+        )
+        if rest:
+            groups = [[] for _ in range(min(len(rest), self.jobs - len(streams)))]
+            loads = [0] * len(groups)
+            for size, name in rest:
+                i = loads.index(min(loads))
+                groups[i].append(name)
+                loads[i] += size
+            streams += groups
+        return streams, views
+
+    def _key_ranges(self, tables: List[Tuple[str, str]]) -> dict:
+        """Get the lowest and highest primary key of each table in one query."""
+        if not tables:
+            return {}
+        query = " UNION ALL ".join(
+            f"SELECT '{name}', MIN(`{key}`), MAX(`{key}`) FROM `{name}`"
+            for name, key in tables
+        )
+        ranges = {}
+        for line in self._query(query):
+            name, low, high = line.split("\t")
+            # an empty table has no range to split
+            if low != "NULL":
+                ranges[name] = (int(low), int(high))
+        return ranges
+
+    @staticmethod
+    def _chunk_streams(
+        table: str, key: str, low: int, high: int, chunks: int
+    ) -> List[List[str]]:
+        """Split a table into streams by primary key range.
+
+        Only the first chunk creates the table and only the last one
+        creates the triggers, so the triggers don't fire while the rows
+        are being restored.  The first and last ranges are left open so
+        no row can fall outside of them.
+        """
+        step = max(1, -(-(high - low + 1) // chunks))
+        bounds = list(range(low + step, high + 1, step))
+        if len(bounds) == 0:
+            return [[table]]
+
+        streams = [["--skip-triggers", f"--where=`{key}` < {bounds[0]}", table]]
+        for start, end in zip(bounds, bounds[1:]):
+            streams.append(
+                [
+                    "--no-create-info",
+                    "--skip-triggers",
+                    f"--where=`{key}` >= {start} AND `{key}` < {end}",
+                    table,
+                ]
+            )
+        streams.append(["--no-create-info", f"--where=`{key}` >= {bounds[-1]}", table])
+        return streams
+
+    def _dump_stream(self, args: List[str], filename: os.PathLike) -> None:
+        """Dump part (or all when args is empty) of the db into a gzipped file."""
+        dump = ["mysqldump", "--single-transaction", "--quick"]
+        dump += self._mysql_args() + [self.mysql.db] + args
+        if self.real:
+            Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self._remote(f"{shlex.join(dump)} | gzip", stdout=filename)
+
+    def _query(self, query: str) -> List[str]:
+        """Run a query on the remote db and return its rows."""
+        mysql = ["mysql", "--batch", "--skip-column-names"] + self._mysql_args()
+        mysql += ["--execute", " ".join(query.split()), self.mysql.db]
+        out = self._remote(shlex.join(mysql))
+        return [i for i in out.splitlines() if i]
+
+    def _mysql_args(self) -> List[str]:
+        args = []
+        if self.mysql.username:
+            args += [f"--user={self.mysql.username}"]
+        if self.mysql.hostname:
+            args += [f"--host={self.mysql.hostname}"]
+        return args
+
+    def _command(self, shell: str):
+        """Build the ssh command that runs a mysql shell command on the server.
+
+        The password has to be sent as the first line of its stdin.
+        """
+        return self._ssh()[shlex.join(["bash", "-c", PREAMBLE + shell])]
+
+    def _remote(
+        self, shell: str, stdout: os.PathLike = None, sql_gz: os.PathLike = None
+    ) -> str:
+        """Run a shell command that uses mysql on the server.
+
+        The password is sent over stdin, followed by the uncompressed
+        contents of sql_gz if given.  If the command fails, stdout is
+        removed and the error is shown.
+
+        :param shell: the command, run by bash with pipefail set.
+        :param stdout: a file to write the output to instead of returning it.
+        :param sql_gz: a gzipped file to send to the command.
+        :return: the output of the command, if stdout is not given.
+        """
+        cmd = self._command(shell)
+
+        if not self.quiet:
+            shown = str(cmd)
+            if sql_gz:
+                shown = f"gunzip --stdout {sql_gz} | {shown}"
+            if stdout:
+                shown = f"{shown} > {stdout}"
+            l.cmd(shown)
+        if not self.real:
+            return ""
+
+        if stdout:
+            out = open(stdout, "wb")
+        elif sql_gz:
+            # let mysql print straight to the terminal
+            out = nullcontext(None)
+        else:
+            out = nullcontext(subprocess.PIPE)
+        with out as out, tempfile.TemporaryFile() as err:
+            if self._cancelled.is_set():
+                raise SystemExit(1)
+            process = cmd.popen(stdin=subprocess.PIPE, stdout=out, stderr=err)
+            with self._processes_lock:
+                self._processes.add(process)
+            try:
+                process.stdin.write(f"{self.mysql.password or ''}\n".encode())
+                if sql_gz:
+                    with gzip.open(sql_gz) as f:
+                        shutil.copyfileobj(f, process.stdin)
+                process.stdin.close()
+            except BrokenPipeError:
+                # the command exited early, its exit code says why
+                pass
+            output = process.stdout.read() if process.stdout else b""
+            process.wait()
+            with self._processes_lock:
+                self._processes.discard(process)
+
+            if process.returncode != 0:
+                if stdout:
+                    Path(stdout).unlink(missing_ok=True)
+                if self._cancelled.is_set():
+                    # stopped because another command failed
+                    raise SystemExit(1)
+                err.seek(0)
+                message = err.read().decode(errors="replace").strip()
+                l.error(
+                    message or f"Command failed with exit code {process.returncode}.",
+                    exit=True,
+                )
+        return output.decode(errors="replace")
+
+    def _ssh(self):
+        return ssh_command(self.server.ssh[0])
+
+
+class _ReadLock:
+
+    def __init__(self, db: DB) -> None:
+        """A mysql session holding FLUSH TABLES WITH READ LOCK on the db.
+
+        While the lock is held nothing can write to the db, so dumps that
+        open their transaction during it all see the same data.
+
+        :param db: the DB to lock.
+        """
+        self.db = db
+        self.process = None
+        self.err = None
+
+    def acquire(self) -> bool:
+        """Take the lock, return false if the server does not allow it."""
+        mysql = ["mysql", "--batch", "--skip-column-names", "--unbuffered"]
+        mysql += self.db._mysql_args() + [self.db.mysql.db]
+        cmd = self.db._command(shlex.join(mysql))
+        if not self.db.quiet:
+            l.cmd(str(cmd))
+
+        self.err = tempfile.TemporaryFile()
+        self.process = cmd.popen(
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.err
+        )
+        self._send(self.db.mysql.password or "")
+        # counting the transactions needs the PROCESS privilege, so check
+        # it now while nothing depends on it
+        self._send(
+            f"SET SESSION lock_wait_timeout = {LOCK_TIMEOUT}; "
+            "FLUSH TABLES WITH READ LOCK; "
+            "SET @locked_at = NOW(); "
+            "SELECT 'locked', COUNT(*) FROM information_schema.innodb_trx;"
+        )
+        return self._read("locked") is not None
+
+    def wait_for(self, count: int, futures: list) -> bool:
+        """Wait until every dump has opened its transaction.
+
+        A dump that has already finished must have opened its
+        transaction while the lock was held, so it counts as started.
+
+        :param count: the number of dumps.
+        :param futures: the running dumps.
+        :return: false if they did not all start in time.
+        """
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            if any(i.done() and i.exception() for i in futures):
+                # the pull is failing anyway
+                return True
+            finished = sum(i.done() for i in futures)
+            self._send(" ".join(STARTED_QUERY.split()))
+            row = self._read("started")
+            if row is None:
+                return False
+            if int(row[0]) + finished >= count:
+                return True
+            time.sleep(0.2)
+        return False
+
+    def release(self) -> None:
+        """Drop the lock and close the session."""
+        if self.process is None:
+            return
+        self._send("UNLOCK TABLES;")
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout=LOCK_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+        self.err.close()
+        self.err = None
+
+    def error(self) -> str:
+        """Get what the session printed to stderr."""
+        if self.err is None:
+            return ""
+        self.err.seek(0)
+        return self.err.read().decode(errors="replace").strip()
+
+    def _send(self, sql: str) -> None:
+        try:
+            self.process.stdin.write(f"{sql}\n".encode())
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            # the session ended, which _read() notices
+            pass
+
+    def _read(self, token: str) -> Optional[List[str]]:
+        """Read output up to the row starting with token, None if the session ended."""
+        while line := self.process.stdout.readline():
+            fields = line.decode(errors="replace").rstrip("\n").split("\t")
+            if fields[0] == token:
+                return fields[1:]
+        return None
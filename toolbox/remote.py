@@ -0,0 +1,128 @@
+import os
+import re
+import shlex
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from plumbum import local
+from pydantic import BaseModel
+
+from toolbox.config import _SSH
+from toolbox.output import l
+
+
+def ssh_command(ssh: _SSH):
+    """Build the ssh command used to reach a server."""
+    args = []
+    if ssh.port:
+        args += ["-p", str(ssh.port)]
+    if ssh.key:
+        args += ["-i", str(ssh.key)]
+    args += [f"{ssh.username}@{ssh.server}"]
+    return local["ssh"][args]
+
+
+def quote_path(path: os.PathLike) -> str:
+    """Quote a remote path for the shell, leaving a leading ~ to be expanded."""
+    path = str(path)
+    if path == "~":
+        return path
+    if path.startswith("~/"):
+        return "~/" + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+class Result(BaseModel):
+    name: str
+    command: str
+    # None when the command was skipped because an earlier one failed
+    returncode: Optional[int] = None
+    stdout: str = ""
+    stderr: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+class Remote:
+
+    def __init__(self, ssh: _SSH) -> None:
+        """Collect shell commands and run them on a server in one session.
+
+        Every command is written into one script which is piped to `sh -s`
+        over a single ssh connection, so a batch costs one round trip no
+        matter how many commands it holds.
+
+        :param ssh: the ssh settings of the server to run on.
+        """
+        self.ssh = ssh
+        self.operations: List[Tuple[str, str]] = []
+
+    def add(self, name: str, command: str) -> None:
+        """Add a command to the batch.
+
+        :param name: used to look up the result of the command.
+        :param command: a shell command, run in its own subshell.
+        """
+        if name in dict(self.operations):
+            raise ValueError(f"Operation '{name}' already added.")
+        self.operations.append((name, command))
+
+    def script(self, marker: str, stop_on_error: bool = False) -> str:
+        """Build the script that runs the batch.
+
+        The output of each command goes to files in a temp dir, which are
+        printed at the end with a marker line before each so they can be
+        split apart again.
+        """
+        lines = ["d=$(mktemp -d) || exit 1", "trap 'rm -rf \"$d\"' EXIT"]
+        for i, (name, command) in enumerate(self.operations):
+            run = f'(\n{command}\n) >"$d/{i}.out" 2>"$d/{i}.err" </dev/null; echo $? >"$d/{i}.rc"'
+            if stop_on_error:
+                run = f'if [ -z "$failed" ]; then {run}; [ "$(cat "$d/{i}.rc")" = 0 ] || failed=1; fi'
+            lines.append(run)
+        lines += [
+            f"for i in {' '.join(str(i) for i in range(len(self.operations)))}; do",
+            "  for f in rc out err; do",
+            '    [ -f "$d/$i.$f" ] || continue',
+            f'    printf \'\\n%s %s %s\\n\' {marker} "$i" "$f"',
+            '    cat "$d/$i.$f"',
+            "  done",
+            "done",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def run(self, stop_on_error: bool = False) -> Dict[str, Result]:
+        """Run the batch and return the result of each command by name.
+
+        :param stop_on_error: skip the remaining commands once one fails.
+        """
+        results = {
+            name: Result(name=name, command=command)
+            for name, command in self.operations
+        }
+        if not self.operations:
+            return results
+
+        marker = f"TOOLBOX-{uuid.uuid4().hex}"
+        cmd = ssh_command(self.ssh)["sh -s"] << self.script(marker, stop_on_error)
+        returncode, stdout, stderr = cmd.run(retcode=None)
+        if returncode != 0:
+            l.error(
+                f"Remote commands failed on {self.ssh.server}: {stderr.strip()}",
+                exit=True,
+            )
+
+        # split() gives the text before the first marker, then the index,
+        # the field and the content for each marker.
+        parts = re.split(rf"\n{marker} (\d+) (rc|out|err)\n", stdout)
+        for i, field, content in zip(parts[1::3], parts[2::3], parts[3::3]):
+            result = results[self.operations[int(i)][0]]
+            if field == "rc":
+                result.returncode = int(content)
+            elif field == "out":
+                result.stdout = content
+            else:
+                result.stderr = content
+        return results
@@ -0,0 +1,190 @@
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+from toolbox.config import project
+from toolbox.config import Action
+from toolbox.output import l
+from toolbox.transfer import Transfer
+
+SNAPSHOT_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+class Snapshots:
+
+    def __init__(
+        self, real: bool, server_name: str, quiet: int = 0, check: bool = False
+    ) -> None:
+        """Initialize the Snapshots class.
+
+        Snapshots of a server are kept in pulls_dir/snapshots/servername,
+        one timestamped dir per pull laid out like the project root.
+
+        :param real: true to actually do the pull, else just print the command.
+        :param server_name: the name of the server to pull from.
+        :param quiet: 1 to output only the snapshot dir, 2 to output nothing.
+        :param check: check the remote path exists before pulling.
+        """
+        if not project.pulls_dir:
+            l.error("Project has no pulls_dir.", exit=True)
+
+        self.transfer = Transfer(
+            real, server_name=server_name, quiet=quiet, check=check
+        )
+        self.real = real
+        self.quiet = quiet
+        self.dir = Path(project.pulls_dir, "snapshots", server_name)
+        # the snapshot a dry run would have made, so prune counts it
+        self.pending = None
+
+    def list(self) -> List[Path]:
+        """Get the finished snapshots, oldest first."""
+        if not self.dir.is_dir():
+            return []
+        snapshots = []
+        for path in self.dir.iterdir():
+            try:
+                datetime.strptime(path.name, SNAPSHOT_FORMAT)
+            except ValueError:
+                # not a snapshot, or a pull that did not finish
+                continue
+            snapshots.append(path)
+        return sorted(snapshots)
+
+    def pull(self, filename: os.PathLike, extra_flags: List = None) -> Path:
+        """Pull a file or dir into a new snapshot.
+
+        Files that have not changed since the previous snapshot are
+        hardlinked to it by rsync's --link-dest instead of being copied,
+        so each snapshot only transfers and stores what changed.  The
+        pull goes into a .partial dir which is renamed when done, so an
+        interrupted pull is never used as the base of the next one.  Any
+        .partial dirs left by failed pulls are deleted first, which is
+        safe as only one pull of a server can run at a time.
+
+        :param filename: the local file or dir matching what to pull.
+        :param extra_flags: additional flags to pass to rsync.
+        :return: the snapshot dir.
+        """
+        name = datetime.now().strftime(SNAPSHOT_FORMAT)
+        snapshot = Path(self.dir, name)
+        partial = Path(self.dir, f"{name}.partial")
+        relative = Path(filename).absolute().relative_to(project.root.absolute())
+
+        with self._locked():
+            if snapshot.exists():
+                l.error(f"Snapshot {snapshot} already exists, try again.", exit=True)
+            self._remove_partials()
+
+            flags = ["--times", "--perms"]
+            if previous := self.list():
+                # --link-dest is relative to the dir being pulled into
+                base = relative if Path(filename).is_dir() else relative.parent
+                flags += [f"--link-dest={Path(previous[-1], base).absolute()}"]
+            if extra_flags:
+                flags += extra_flags
+
+            dest = Path(partial, relative)
+            if self.real:
+                partial.mkdir(parents=True)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+            self.transfer.transfer(Action.PULL, filename, flags, dest=dest)
+
+            if not self.real:
+                self.pending = snapshot
+                return snapshot
+            partial.rename(snapshot)
+
+        if self.quiet == 1:
+            print(snapshot)
+        elif not self.quiet:
+            l.info(f"Saved {snapshot}")
+        return snapshot
+
+    @contextmanager
+    def _locked(self):
+        """Hold a lock on the snapshot dir so only one pull of a server runs at once."""
+        if not self.real and not self.dir.is_dir():
+            # nothing to protect and a dry run creates nothing
+            yield
+            return
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(Path(self.dir, ".lock"), "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                l.error(f"Another pull into {self.dir} is running.", exit=True)
+            yield
+
+    def _remove_partials(self) -> None:
+        """Delete the dirs left behind by pulls that did not finish."""
+        if not self.dir.is_dir():
+            return
+        for path in sorted(self.dir.glob("*.partial")):
+            if not self.quiet:
+                l.info(f"{'Deleting' if self.real else 'Would delete'} {path}")
+            if self.real:
+                shutil.rmtree(path)
+
+    def prune(self, keep: int) -> List[Path]:
+        """Delete all but the newest snapshots.
+
+        Files shared with the snapshots that are kept are hardlinks, so
+        they stay on disk.
+
+        :param keep: the number of snapshots to keep.
+        :return: the deleted (or, if not real, the to be deleted) snapshots.
+        """
+        with self._locked():
+            snapshots = self.list()
+            if self.pending:
+                snapshots.append(self.pending)
+            old = snapshots[:-keep]
+            for snapshot in old:
+                if not self.quiet:
+                    l.info(f"{'Deleting' if self.real else 'Would delete'} {snapshot}")
+                if self.real:
+                    shutil.rmtree(snapshot)
+        return old
+
+    def sizes(self) -> List[Tuple[Path, int, int]]:
+        """Get the size of each snapshot, oldest first.
+
+        :return: the snapshot, its full size and the size of the files
+            that are not hardlinks to an older snapshot, in bytes.
+        """
+        seen = set()
+        sizes = []
+        for snapshot in self.list():
+            total = 0
+            new = 0
+            for root, dirs, files in os.walk(snapshot):
+                for f in files:
+                    stat = os.lstat(os.path.join(root, f))
+                    total += stat.st_size
+                    if (stat.st_dev, stat.st_ino) not in seen:
+                        seen.add((stat.st_dev, stat.st_ino))
+                        new += stat.st_size
+            sizes.append((snapshot, total, new))
+        return sizes
+
+    def report(self) -> None:
+        """Log the size of each snapshot and the disk used by them all."""
+        sizes = self.sizes()
+        for snapshot, total, new in sizes:
+            l.info(f"{snapshot.name}  {_human(total):>9}  {_human(new):>9} new")
+        l.info(f"{len(sizes)} snapshots, {_human(sum(i[2] for i in sizes))} on disk")
+
+
+def _human(size: int) -> str:
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "T"
+    return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
@@ -0,0 +1,39 @@
+import subprocess
+import threading
+from typing import Callable, IO
+
+
+def stream(
+    process: subprocess.Popen,
+    on_stdout: Callable[[str], None],
+    on_stderr: Callable[[str], None],
+) -> int:
+    """Hand the output of a process to callbacks one line at a time.
+
+    stdout and stderr are each read by their own thread so neither pipe
+    can fill up and block the process.  Only one line of each is held at
+    a time, so memory stays the same however much the process prints.
+
+    :param process: started with stdout and stderr set to PIPE.
+    :param on_stdout: called with each line of stdout, without the newline.
+    :param on_stderr: called with each line of stderr, without the newline.
+    :return: the exit code of the process.
+    """
+    readers = [
+        threading.Thread(target=_read, args=(process.stdout, on_stdout), daemon=True),
+        threading.Thread(target=_read, args=(process.stderr, on_stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    process.wait()
+    for reader in readers:
+        reader.join()
+    return process.returncode
+
+
+def _read(pipe: IO, callback: Callable[[str], None]) -> None:
+    with pipe:
+        for line in pipe:
+            if isinstance(line, bytes):
+                line = line.decode(errors="replace")
+            callback(line.rstrip("\r\n"))
@@ -1,10 +1,14 @@
+import os
+import shlex
 from pprint import pprint as pp
 
 import click
 
 from toolbox.config import Action
 from toolbox.config import project
+from toolbox.db import DB
 from toolbox.output import l
+from toolbox.snapshot import Snapshots
 from toolbox.transfer import Transfer
 from pathlib import Path
 
@@ -73,9 +77,10 @@ def toolbox(suppress_commands):
     help="-q: Output only the filename, -qq: output nothing.")
 @click.option("--real", "-r", is_flag=True,
     help="Run the command for real.")
-@click.pass_context
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1,
+    help="Number of connections to dump tables over at once when pulling.")
 # fmt: on
-def database(action, sql_gz, server, quiet, real, tag):
+def database(action, sql_gz, server, quiet, real, tag, jobs):
     """Overwrite a db with a gzipped sql file.
 
     \b
@@ -89,6 +94,13 @@ def database(action, sql_gz, server, quiet, real, tag):
 
     \b
     pulls_dir/projectname-servername-20-01-01_01-01-01.sql.gz
+
+    With --jobs, tables (and ranges of large tables) are dumped over
+    several connections at once and joined into the same single
+    gzipped file.  The db is read locked for a moment while the
+    connections start so they all see the same data.  If the db user
+    may not lock, a warning is shown and the file is not a
+    point-in-time copy.
     """
 
     if not project.in_project:
@@ -96,27 +108,17 @@ def database(action, sql_gz, server, quiet, real, tag):
     else:
         l.info(f"Project: {project.name}")
 
-    # pp(project.model_dump())
-
-    print("-" * 80)
-
     try:
-        x = project.get_server_by_name("prod")
+        db = DB(real=real, server_name=server, quiet=quiet, jobs=jobs)
     except IndexError as e:
         l.error(e, exit=True)
-    except TypeError as e:
-        l.error(e, exit=True)
-
-    print(x.name, x.root)
 
-    # db = DB(real=real, quiet=quiet)
-    #
-    # if action == Action.PULL.value:
-    #     db.pull(server, tag=tag)
-    # elif action == Action.PUT.value:
-    #     if not sql_gz:
-    #         ui.error('When action is "put", SQL-GZ is required.')
-    #     db.put(server, sql_gz)
+    if action == Action.PULL.value:
+        db.pull(tag=tag)
+    elif action == Action.PUT.value:
+        if not sql_gz:
+            l.error('When action is "put", SQL-GZ is required.', exit=True)
+        db.put(sql_gz)
 
 
 # ------------------------------- Files -------------------------------
@@ -130,14 +132,25 @@ def database(action, sql_gz, server, quiet, real, tag):
     help="-q: Output only the filename, -qq: output nothing.")
 @click.option('--extra-flags',
     help='extra flags to pass to rsync.')
+@click.option('--check', is_flag=True,
+    help='Check the remote paths exist first (one extra ssh session).')
+@click.option('--snapshot', is_flag=True,
+    help='Pull into a new timestamped snapshot in the pulls_dir.')
+@click.option('--keep', type=click.IntRange(min=1),
+    help='With --snapshot, delete all but the newest KEEP snapshots.')
 # fmt: on
-def files(action, filename, server, real, quiet, extra_flags):
+def files(action, filename, server, real, quiet, extra_flags, check, snapshot, keep):
     """Send files to and fro.
     Push or pull a single file or directory from a remote server.
     \b
     ACTION: pull or put
     SERVER: server name, if not specified sink will use the default server.
-    FILENAME: file/dir to be transferred."""
+    FILENAME: file/dir to be transferred.
+
+    With --snapshot, each pull goes into its own dir in
+    pulls_dir/snapshots/servername.  Files unchanged since the last
+    snapshot are hardlinked to it, so only changes are transferred and
+    stored."""
 
     if not project.in_project:
         l.error("Not in a project.", exit=True)
@@ -148,12 +161,29 @@ def files(action, filename, server, real, quiet, extra_flags):
     if filename and action == Action.PUT.value and not os.path.exists(filename):
         l.error(f"File '{filename}' does not exist.", exit=True)
 
+    if extra_flags:
+        extra_flags = shlex.split(extra_flags)
+
     if filename:
         f = Path(os.path.abspath(filename))
     else:
         f = Path(project.root)
 
-    transfer = Transfer(real, server_name=server, quiet=quiet)
+    if keep and not snapshot:
+        l.error("--keep can only be used with --snapshot.", exit=True)
+
+    if snapshot:
+        if action != Action.PULL.value:
+            l.error("--snapshot can only be used when pulling.", exit=True)
+        snapshots = Snapshots(real, server_name=server, quiet=quiet, check=check)
+        snapshots.pull(f, extra_flags)
+        if keep:
+            snapshots.prune(keep)
+        if not quiet:
+            snapshots.report()
+        return
+
+    transfer = Transfer(real, server_name=server, quiet=quiet, check=check)
     transfer.transfer(action, f, extra_flags)
 
     # if action == Action.PULL.value:
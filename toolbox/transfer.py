@@ -1,5 +1,8 @@
 import os
+import shlex
 import sys
+import time
+from collections import deque
 from pathlib import Path
 from plumbum import local
 from plumbum.cmd import rsync
@@ -8,32 +11,53 @@ from typing import List
 from toolbox.config import project
 from toolbox.config import Action
 from toolbox.output import l
+from toolbox.remote import Remote, quote_path
+from toolbox.stream import stream
+
+# Seconds between progress messages while rsync runs.
+PROGRESS_INTERVAL = 5
+
+# rsync's exit code when source files were deleted while it ran, which
+# is normal for the cache and upload dirs of a live site.
+RSYNC_VANISHED = 24
 
 
 class Transfer:
 
-    def __init__(self, real: bool, server_name: str, quiet: object = False) -> None:
+    def __init__(
+        self, real: bool, server_name: str, quiet: object = False, check: bool = False
+    ) -> None:
         """Initialize the Transfer class.
 
         :param real: true to actually do the transfer, else just print the command.
         :param server_name: the name of the server to transfer to or from.
         :param quiet:
+        :param check: check the remote paths exist before transferring.
         """
         self.server = project.get_server_by_name(server_name)
         self.real = real
         self.quiet = quiet
+        self.check = check
 
     def transfer(
-        self, action: Action, filename: os.PathLike, extra_flags: List = None
+        self,
+        action: Action,
+        filename: os.PathLike,
+        extra_flags: List = None,
+        dest: os.PathLike = None,
     ) -> None:
         """Transfer a file to or from a remote server.
 
         :param action: Action.PULL or Action.PUT
         :param filename:  the local file name to transfer
         :param extra_flags: additional flags to pass to rsync
+        :param dest: when pulling, the local path to pull into instead of filename
         """
+        action = Action(action)
         remote = self._get_matching_remote(filename)
-        self._rsync(action, filename, remote, extra_flags)
+        if self.check:
+            self._check_remote(action, remote)
+        self._rsync(action, filename, remote, extra_flags, dest)
 
     def _get_matching_remote(self, filename: os.PathLike) -> os.PathLike:
         """Get the remote path that matches the local path."""
@@ -47,32 +71,66 @@ class Transfer:
             l.error(f"Server has no root ({self.server.servername}).")
         return remote
 
+    def _check_remote(self, action: Action, remote: os.PathLike) -> None:
+        """Check the server before transferring, all in one ssh session.
+
+        This costs a round trip on top of rsync's, so it is only done
+        when asked for.
+        """
+        batch = Remote(self.server.ssh[0])
+        batch.add("root", f"test -d {quote_path(self.server.root)}")
+        if action == Action.PULL:
+            batch.add("source", f"test -e {quote_path(remote)}")
+        else:
+            batch.add("dest", f"test -d {quote_path(os.path.dirname(remote))}")
+
+        if not self.quiet:
+            for _, command in batch.operations:
+                l.cmd(command)
+        # the other checks mean nothing without the root
+        results = batch.run(stop_on_error=True)
+
+        if not results["root"].ok:
+            l.error(f"Server root does not exist ({self.server.root}).", exit=True)
+        if "source" in results and not results["source"].ok:
+            l.error(f"Remote file does not exist ({remote}).", exit=True)
+        if "dest" in results and not results["dest"].ok:
+            l.error(
+                f"Remote dir does not exist ({os.path.dirname(remote)}).", exit=True
+            )
+
     def _rsync(
         self,
         action: Action,
         local_file: os.PathLike,
         remote: os.PathLike,
         extra_flags: List = None,
+        dest: os.PathLike = None,
     ) -> None:
 
+        if dest is None:
+            dest = local_file
+
         args = []
 
         if not self.real:
             args += ["--dry-run"]
 
         ssh = self.server.ssh[0]
+        rsh = ["ssh"]
+        if ssh.port:
+            # https://stackoverflow.com/a/4630407
+            rsh += ["-p", str(ssh.port)]
         if ssh.key:
-            args += ["--rsh", f'"ssh -i {ssh.key}"']
+            rsh += ["-i", str(ssh.key)]
+        if len(rsh) > 1:
+            args += ["--rsh", shlex.join(rsh)]
 
         args += ["--links", "--compress", "--checksum", "--itemize-changes"]
 
         if extra_flags:
             args += extra_flags
 
-        if ssh.port:
-            # https://stackoverflow.com/a/4630407
-            args += ["-e", f'"-p {ssh.port}"']
-
         # if transferring a dir, add the recursive flag, any excludes and
         # end the dirs with trailing slashes.
         if local_file.is_dir():
@@ -80,34 +138,98 @@ class Transfer:
 
             project_excludes = [] if not project.exclude else project.exclude
             server_excludes = [] if not self.server.exclude else self.server.exclude
-            if excludes := list(set(project_excludes + server_excludes)):
-                excludes = ",".join(f'"{i}"' for i in excludes)
-                args += ["--exclude", f"'{{{excludes}}}'"]
+            for exclude in sorted(set(project_excludes + server_excludes)):
+                args += ["--exclude", exclude]
 
-            local_file = os.path.join(
-                local_file, ""
-            )  # append a slash to the end of the path
-            remote = os.path.join(remote, "")  # append a slash to the end of the path
+            # append a slash to the end of the paths
+            local_file = os.path.join(local_file, "")
+            dest = os.path.join(dest, "")
+            remote = os.path.join(remote, "")
 
-        if action == Action.PUT and (s.group or s.user):
+        if action == Action.PUT and (self.server.group or self.server.user):
             # To have rsync change owner or group, the '--group' and
             # '--owner' flags have to be used as well as '--chown'
             # otherwise they will be ignored.
-            args += [
-                "--group" if self.server.group else "",
-                "--owner" if self.server.user else "",
-                "--chown",
-                f"{self.server.group}:{self.server.user}",
-            ]
-
-        if action == Action.PUT.value:
+            owner = self.server.user or ""
+            if self.server.group:
+                args += ["--group"]
+                owner += f":{self.server.group}"
+            if self.server.user:
+                args += ["--owner"]
+            args += ["--chown", owner]
+
+        if action == Action.PUT:
             args += [local_file, f"{ssh.username}@{ssh.server}:{remote}"]
         else:
-            args += [f"{ssh.username}@{ssh.server}:{remote}", local_file]
+            args += [f"{ssh.username}@{ssh.server}:{remote}", dest]
 
         rsync_cmd = "rsync"
-        if custom_rsync_cmd := project.rsync_binary[sys.platform]:
+        if custom_rsync_cmd := (project.rsync_binary or {}).get(sys.platform):
             rsync_cmd = custom_rsync_cmd
         rsync = local[rsync_cmd]
         rsync = rsync[args]
-        print(str(rsync))
+        if not self.quiet:
+            l.cmd(str(rsync))
+
+        # rsync lists every file it touches, so its output is handled a
+        # line at a time as it arrives instead of being collected.
+        progress = _Progress(self.quiet)
+        returncode = stream(
+            rsync.popen(stdin=None), progress.stdout_line, progress.stderr_line
+        )
+        progress.done()
+        if returncode == RSYNC_VANISHED:
+            if self.quiet < 2:
+                l.warning(
+                    f"Some files vanished while rsync ran ({progress.changes} "
+                    f"changed, {progress.deletions} deleted, "
+                    f"{progress.vanished} vanished)."
+                )
+        elif returncode != 0:
+            errors = "\n".join(progress.errors)
+            l.error(f"rsync failed with exit code {returncode}.\n{errors}", exit=True)
+
+
+class _Progress:
+
+    def __init__(self, quiet: int = 0) -> None:
+        """Count and show the lines rsync outputs, keeping only a few of them.
+
+        :param quiet: if set, show nothing but keep counting.
+        """
+        self.quiet = quiet
+        self.changes = 0
+        self.deletions = 0
+        self.vanished = 0
+        # the last lines of stderr, to explain a failure
+        self.errors = deque(maxlen=20)
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def stdout_line(self, line: str) -> None:
+        if line.startswith("*deleting"):
+            self.deletions += 1
+        elif line:
+            self.changes += 1
+        if self.quiet:
+            return
+
+        print(line)
+        now = time.monotonic()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            l.info(f"{self.changes} changed, {self.deletions} deleted so far...")
+
+    def stderr_line(self, line: str) -> None:
+        if line.startswith("file has vanished:"):
+            self.vanished += 1
+        self.errors.append(line)
+        if not self.quiet:
+            l.warning(line)
+
+    def done(self) -> None:
+        if not self.quiet:
+            seconds = time.monotonic() - self.started
+            l.info(
+                f"{self.changes} changed, {self.deletions} deleted in {seconds:.1f}s."
+            )